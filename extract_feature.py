@@ -19,6 +19,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 from keras import backend as K
 from keras.models import Sequential, Model
+from keras.layers import Lambda
 from skimage.io import imsave
 from sklearn.cluster import KMeans
 from sklearn import manifold
@@ -101,7 +102,20 @@ def main():
     print(len(model.layers))
     print(model.layers)
     layer_name = 'convnet_trunk'
-    layer_outputs = [model.get_layer(layer_name).get_output_at(2)]
+    layer_names = [layer.name for layer in model.layers]
+    trunk = model.get_layer(layer_name)
+    if 'combined_data' in layer_names:
+        # Shared trunk: node 1 runs on the self and supervised batches stacked
+        # along the batch axis; keep the rows of the self-supervised batch.
+        self_maps = Lambda(lambda t: t[0][:K.shape(t[1])[0]])(
+            [trunk.get_output_at(1), model.get_layer('self_data').output])
+    elif 'self_gap' in layer_names:
+        # Separate trunk calls: node 1 is super_data, node 2 is self_data.
+        self_maps = trunk.get_output_at(2)
+    else:
+        raise ValueError('Unrecognised SESEMI model topology: expected a '
+                         '`combined_data` or `self_gap` layer.')
+    layer_outputs = [self_maps]
     # extract the ouputs of the top 6 layers
     activation_model = Model(inputs=model.input,outputs=layer_outputs)
     steps = len(x_test)/batch_size
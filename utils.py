@@ -7,20 +7,22 @@ import scipy
 from scipy import ndimage
 from sklearn.metrics import accuracy_score
 import tensorflow as tf
+import numba
 # Keras package imports
 from keras.models import Model
 from keras.layers import GlobalAveragePooling2D
 from keras.layers import Dropout, Dense, Input, Activation
+from keras.layers import Concatenate, Lambda
 from keras import optimizers
 from keras.regularizers import l2
 from keras import backend as K
 from keras import initializers
 from keras.callbacks import Callback
-from keras.utils import to_categorical
 
 # Set seed number for reproducible randomness.
 seed_number = 1
 np.random.seed(seed_number)
+_RNG = np.random.default_rng(seed_number)
 
 weight_decay = 0.0005
 initer = initializers.glorot_uniform(seed=seed_number)
@@ -32,34 +34,82 @@ fc_params = dict(
         use_bias=True,
     )
 
+# One-hot labels for the six geometric transforms.
+_PROXY_ONEHOT = np.eye(6, dtype='float32')
+
+# float32 value in [0, 1] of every uint8 pixel value.
+_UINT8_TO_UNIT = np.arange(256, dtype='float32') / 255.
+
+# Source pixel of every destination pixel under each geometric transform:
+# rotations by 0, 90, 180 and 270 degrees, then horizontal and vertical flips.
+_pixel_grid = np.arange(32 * 32).reshape((32, 32))
+_TRANSFORM_LUT = np.stack([np.rot90(_pixel_grid, 0),
+                           np.rot90(_pixel_grid, 1),
+                           np.rot90(_pixel_grid, 2),
+                           np.rot90(_pixel_grid, 3),
+                           np.fliplr(_pixel_grid),
+                           np.flipud(_pixel_grid)]).reshape((6, -1))
+
 
 def geometric_transform(image, proxy_labels=6):
-    images, labels = [], []
-    image = np.reshape(image, (32, 32, 3))
-    for i in range(proxy_labels):
-        if i <= 3:
-            t = np.rot90(image, i)
-        elif i == 4:
-            t = np.fliplr(image)
-        else:
-            t = np.flipud(image)
-        images.append(t)
-        labels.append(to_categorical(i, proxy_labels))
+    if proxy_labels > len(_PROXY_ONEHOT):
+        raise ValueError('`proxy_labels` must be at most %d.'
+                         % len(_PROXY_ONEHOT))
+    image = np.reshape(image, (32 * 32, 3))
+    images = image[_TRANSFORM_LUT[:proxy_labels]].reshape((-1, 32, 32, 3))
+    # Copy so callers cannot modify the shared table through the labels.
+    labels = list(_PROXY_ONEHOT[:proxy_labels, :proxy_labels].copy())
+    return list(images), labels
+
+
+def geometric_transform_batch(batch, proxy_labels=6):
+    """Vectorised `geometric_transform` over a batch of images.
+
+    Returns the `proxy_labels` transforms of each image consecutively,
+    shape=(proxy_labels * n_images, 32, 32, 3), with matching one-hot labels.
+    """
+    if proxy_labels > len(_PROXY_ONEHOT):
+        raise ValueError('`proxy_labels` must be at most %d.'
+                         % len(_PROXY_ONEHOT))
+    batch = np.reshape(batch, (-1, 32 * 32, 3))
+    # One gather gives shape=(n_images, proxy_labels, 32 * 32, 3).
+    images = batch[:, _TRANSFORM_LUT[:proxy_labels], :]
+    images = images.reshape((-1, 32, 32, 3))
+    labels = np.tile(_PROXY_ONEHOT[:proxy_labels, :proxy_labels],
+                     (len(batch), 1))
     return images, labels
         
         
+@numba.njit(parallel=True, cache=True)
+def _gcn_rows(images, scale, eps):
+    """In-place global contrast normalization, one row per thread."""
+    n, d = images.shape
+    for i in numba.prange(n):
+        row = images[i]
+        mean = 0.0
+        for j in range(d):
+            mean += row[j]
+        mean /= d
+        sq = 0.0
+        for j in range(d):
+            row[j] -= mean
+            sq += row[j] * row[j]
+        norm = np.sqrt(sq)
+        if norm < eps:
+            norm = 1.0
+        factor = scale / norm
+        for j in range(d):
+            row[j] *= factor
+
+
 def global_contrast_normalize(images, scale=55, eps=1e-10):
     images = images.astype('float32')
     n, h, w, c = images.shape
     # Flatten images to shape=(nb_images, nb_features)
     images = images.reshape((n, h*w*c))
-    # Subtract out the mean of each image
-    images -= images.mean(axis=1, keepdims=True)
-    # Divide out the norm of each image
-    per_image_norm = np.linalg.norm(images, axis=1, keepdims=True)
-    # Avoid divide-by-zero
-    per_image_norm[per_image_norm < eps] = 1.0
-    return float(scale) * images / per_image_norm
+    # Subtract the mean and divide out the norm of each image, in place
+    _gcn_rows(images, float(scale), float(eps))
+    return images
 
 
 def zca_whitener(images, identity_scale=0.1, eps=1e-10):
@@ -70,54 +120,83 @@ def zca_whitener(images, identity_scale=0.1, eps=1e-10):
     Returns:
         A function which applies ZCA to an array of flattened images
     """
-    image_covariance = np.cov(images, rowvar=False)
-    U, S, _ = np.linalg.svd(
-        image_covariance + identity_scale * np.eye(*image_covariance.shape)
-    )
-    zca_decomp = np.dot(U, np.dot(np.diag(1. / np.sqrt(S + eps)), U.T))
-    image_mean = images.mean(axis=0)
-    return lambda x: np.dot(x - image_mean, zca_decomp)
+    n = images.shape[0]
+    # Centre in float64, as np.cov did, whatever the input precision.
+    image_mean = images.mean(axis=0, dtype=np.float64)
+    centred = images.astype(np.float64)
+    centred -= image_mean
+    image_covariance = np.dot(centred.T, centred) / (n - 1)
+    del centred
+    # The covariance is symmetric, so eigh replaces the general SVD; adding
+    # identity_scale to its eigenvalues matches factorising cov + scale * I.
+    eigvals, eigvecs = np.linalg.eigh(image_covariance)
+    eigvals = np.maximum(eigvals, 0.)
+    inv_sqrt = 1. / np.sqrt(eigvals + identity_scale + eps)
+    zca_decomp = np.dot(eigvecs * inv_sqrt, eigvecs.T)
+    # Keep the apply step in float32 so np.dot runs single-precision BLAS.
+    zca_decomp = zca_decomp.astype(np.float32, copy=False)
+    image_mean = image_mean.astype(np.float32, copy=False)
+    return lambda x: np.dot(x.astype(np.float32, copy=False) - image_mean,
+                            zca_decomp)
 
 
 def stratified_sample(label_array, labels_per_class):
+    labels = np.asarray(label_array)
+    # A stable sort groups the indices of each class in ascending order.
+    order = np.argsort(labels, kind='stable')
+    ends = np.cumsum(np.bincount(labels))
     samples = []
-    for cls in range(len(set(label_array))):
-        inds = np.where(label_array == cls)[0]
+    for start, end in zip(np.concatenate(([0], ends[:-1])), ends):
+        inds = order[start:end]
         np.random.shuffle(inds)
-        inds = inds[:labels_per_class].tolist()
-        samples.extend(inds)
-    return samples
+        samples.append(inds[:labels_per_class])
+    return np.concatenate(samples)
 
 
-def gaussian_noise(image, stddev=0.15):
-    return image + np.random.randn(*image.shape) * stddev
+def gaussian_noise(image, stddev=0.15, out=None):
+    noise = _RNG.standard_normal(size=np.shape(image), dtype=np.float32)
+    noise *= stddev
+    return np.add(image, noise, out=out)
 
 
-def transform_matrix_offset_center(matrix, x, y):
-    o_x = float(x) / 2 + 0.5
-    o_y = float(y) / 2 + 0.5
-    offset_matrix = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
-    reset_matrix = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
-    transform_matrix = np.dot(np.dot(offset_matrix, matrix), reset_matrix)
-    return transform_matrix
+# scipy.ndimage boundary modes and their np.pad equivalents.
+_PAD_MODES = {'reflect': 'symmetric', 'nearest': 'edge', 'constant': 'constant'}
+
+
+def _sample_jitter_params(n, rng=_RNG):
+    """Draw `n` row and column shifts, each from {-2, -1, 1, 2}."""
+    tx = rng.choice([-2, -1, 1, 2], size=n)
+    ty = rng.choice([-2, -1, 1, 2], size=n)
+    return tx, ty
 
 
 def jitter(image, row_axis=0, col_axis=1, channel_axis=2,
-           fill_mode='reflect', cval=0.0, order=1):
-    tx = np.random.choice([1, 2])
-    tx *= np.random.choice([-1, 1])
-    ty = np.random.choice([1, 2])
-    ty *= np.random.choice([-1, 1])
-    
-    transform_matrix = np.array([[1, 0, tx],
-                                 [0, 1, ty],
-                                 [0, 0, 1]])
+           fill_mode='reflect', cval=0.0, order=1, tx=None, ty=None):
+    if tx is None or ty is None:
+        (tx,), (ty,) = _sample_jitter_params(1)
     h, w = image.shape[row_axis], image.shape[col_axis]
-    transform_matrix = transform_matrix_offset_center(
-            transform_matrix, h, w)
+
+    integer_shift = float(tx).is_integer() and float(ty).is_integer()
+    if order <= 1 and fill_mode in _PAD_MODES and integer_shift:
+        # Integer translations need no interpolation: pad, then crop.
+        tx, ty = int(tx), int(ty)
+        pad = max(abs(tx), abs(ty))
+        pad_width = [(0, 0)] * image.ndim
+        pad_width[row_axis] = (pad, pad)
+        pad_width[col_axis] = (pad, pad)
+        pad_kwargs = {'constant_values': cval} if fill_mode == 'constant' else {}
+        padded = np.pad(image, pad_width, mode=_PAD_MODES[fill_mode],
+                        **pad_kwargs)
+        window = [slice(None)] * image.ndim
+        window[row_axis] = slice(pad + tx, pad + tx + h)
+        window[col_axis] = slice(pad + ty, pad + ty + w)
+        return padded[tuple(window)]
+
+    # Centring offsets cancel for a pure translation, leaving an identity
+    # matrix (passed as its diagonal) and the shift itself as the offset.
     image = np.rollaxis(image, channel_axis, 0)
-    final_affine_matrix = transform_matrix[:2, :2]
-    final_offset = transform_matrix[:2, 2]
+    final_affine_matrix = np.ones(2)
+    final_offset = np.array([tx, ty], dtype=np.float64)
 
     channel_images = [ndimage.interpolation.affine_transform(
         image_channel,
@@ -131,18 +210,59 @@ def jitter(image, row_axis=0, col_axis=1, channel_axis=2,
     return image
 
 
+def jitter_batch(images, fill_mode='reflect', cval=0.0, order=1):
+    """Batched `jitter` over channel-last images, shape=(n_images, h, w, c),
+    drawing an independent shift for each image.
+    """
+    n, h, w = images.shape[:3]
+    tx, ty = _sample_jitter_params(n)
+
+    if order <= 1 and fill_mode in _PAD_MODES:
+        # Pad the whole batch once, then gather each image's shifted window.
+        pad = int(np.abs(np.concatenate((tx, ty))).max(initial=0))
+        pad_kwargs = {'constant_values': cval} if fill_mode == 'constant' else {}
+        padded = np.pad(images, ((0, 0), (pad, pad), (pad, pad), (0, 0)),
+                        mode=_PAD_MODES[fill_mode], **pad_kwargs)
+        rows = pad + tx[:, None] + np.arange(h)
+        cols = pad + ty[:, None] + np.arange(w)
+        return padded[np.arange(n)[:, None, None],
+                      rows[:, :, None], cols[:, None, :]]
+
+    # ndimage.shift samples input[o - shift], hence the negated offsets.
+    return np.stack([ndimage.shift(image, (-x, -y, 0), order=order,
+                                   mode=fill_mode, cval=cval)
+                     for image, x, y in zip(images, tx, ty)])
+
+
+def _draw_batch(iterator, nb_samples, out=None):
+    """Draw `nb_samples` single-image batches from a Keras iterator.
+
+    Images are written straight into `out` (allocated if None). Returns the
+    images, or an `(images, labels)` tuple if the iterator yields labels.
+    """
+    x, y = out, None
+    for i in range(nb_samples):
+        batch = next(iterator)
+        x_i, y_i = batch if isinstance(batch, tuple) else (batch, None)
+        if x is None:
+            x = np.empty((nb_samples,) + x_i.shape[1:], dtype=x_i.dtype)
+        x[i:i + 1] = x_i
+        if y_i is not None:
+            if y is None:
+                y = np.empty((nb_samples,) + y_i.shape[1:], dtype=y_i.dtype)
+            y[i:i + 1] = y_i
+    return x if y is None else (x, y)
+
+
 def datagen(super_iter, self_iter, batch_size):
     """Utility function to load data into required Keras model format."""
     super_batch = 192
     self_batch = batch_size
     while(True):
-        x_super, y_super = zip(*[next(super_iter) for _ in range(super_batch)])
-        x_self, y_self = zip(*[geometric_transform(next(self_iter))
-                               for _ in range(self_batch)])
-        x_super = np.vstack(x_super)
-        y_super = np.vstack(y_super)
-        x_self = np.vstack(x_self)
-        y_self = np.vstack(y_self)
+        # Fresh buffers per batch: Keras may queue several batches ahead.
+        x_super, y_super = _draw_batch(super_iter, super_batch)
+        x_self = _draw_batch(self_iter, self_batch)
+        x_self, y_self = geometric_transform_batch(x_self)
         yield ([x_self, x_super], [y_self, y_super])
 
 
@@ -151,19 +271,15 @@ def datagen_tinyimages(super_iter, self_iter, extra_iter, batch_size):
     super_batch = 192
     self_batch = batch_size
     extra_batch = 32 - batch_size # self_batch + extra_batch = 32
-    inds = np.arange(super_batch)
     while(True):
-        x_super, y_super = zip(*[next(super_iter) for _ in range(super_batch)])
-        x_self, y_self = zip(*[geometric_transform(next(self_iter))
-                               for _ in range(self_batch)])
-        x_extra, y_extra = zip(*[geometric_transform(next(extra_iter))
-                                 for _ in range(extra_batch)])
-        x_super = np.vstack(x_super)
-        y_super = np.vstack(y_super)
-        x_self = np.vstack(x_self + x_extra)
-        y_self = np.vstack(y_self + y_extra)
-        # Shuffle in batch.
-        np.random.shuffle(inds)
+        x_super, y_super = _draw_batch(super_iter, super_batch)
+        x_self = np.empty((self_batch + extra_batch, 32, 32, 3),
+                          dtype='float32')
+        _draw_batch(self_iter, self_batch, out=x_self[:self_batch])
+        _draw_batch(extra_iter, extra_batch, out=x_self[self_batch:])
+        x_self, y_self = geometric_transform_batch(x_self)
+        # Shuffle in batch, sized by the self-supervised rows (32 * 6).
+        inds = _RNG.permutation(len(x_self))
         x_self = x_self[inds]
         y_self = y_self[inds]
         yield ([x_self, x_super], [y_self, y_super])
@@ -172,13 +288,11 @@ def datagen_tinyimages(super_iter, self_iter, extra_iter, batch_size):
 def load_tinyimages(indices):
     dirname = './datasets/tiny-images'
     fpath = os.path.join(dirname, 'tiny_images.bin')
-    images = np.zeros((len(indices), 3, 32, 32), dtype='float32')
-    with open(fpath, 'rb') as f:
-        for i, idx in enumerate(indices):
-            f.seek(3072 * idx)
-            image = np.fromfile(f, dtype='uint8', count=3072)
-            images[i] = np.reshape(image, (3, 32, 32))
-    images = np.transpose(images, (0, 3, 2, 1)) / 255.
+    # Each record is 3072 bytes; gather all requested records in one go.
+    records = np.memmap(fpath, dtype='uint8', mode='r').reshape((-1, 3, 32, 32))
+    # Converting through the table scales to [0, 1] in the same pass.
+    images = _UINT8_TO_UNIT[records[np.asarray(indices)]]
+    images = np.transpose(images, (0, 3, 2, 1))
     return images
 	
 # define the vat-loss for semi-supervised learning
@@ -210,26 +324,44 @@ def vat_loss(cnn_trunk,input_shape,self_out,self_in):
     vat_loss1 = tf.reduce_mean(compute_kld(p_logit_no_gradient, p_logit_r_adv))
     return vat_loss1'''
 			
-def open_sesemi(model, input_shape, nb_classes, lrate, dropout):
+def open_sesemi(model, input_shape, nb_classes, lrate, dropout,
+                shared_trunk=False):
     cnn_trunk = model.create_model(input_shape)
     #resnet50_trunk = model.create_model(input_shape)
 	
     super_in = Input(shape=input_shape, name='super_data')
     self_in = Input(shape=input_shape, name='self_data')
-    super_out = cnn_trunk(super_in)
-    self_out = cnn_trunk(self_in)
-    
-    super_out = GlobalAveragePooling2D(name='super_gap')(super_out)
+    if shared_trunk:
+        # Opt-in: run the trunk once over both batches stacked along the
+        # batch axis, then split the pooled features at the self batch size.
+        # BatchNormalization then sees mixed batches, which changes training.
+        combined_in = Concatenate(axis=0, name='combined_data')(
+            [self_in, super_in])
+        gap = GlobalAveragePooling2D(name='gap')
+        features = gap(cnn_trunk(combined_in))
+        self_out = Lambda(lambda t: t[0][:K.shape(t[1])[0]],
+                          name='self_features')([features, self_in])
+        super_out = Lambda(lambda t: t[0][K.shape(t[1])[0]:],
+                           name='super_features')([features, self_in])
+        super_features = gap(cnn_trunk(super_in))
+    else:
+        super_out = cnn_trunk(super_in)
+        self_out = cnn_trunk(self_in)
+        super_out = GlobalAveragePooling2D(name='super_gap')(super_out)
+        self_out = GlobalAveragePooling2D(name='self_gap')(self_out)
+        super_features = super_out
     if dropout > 0.0:
         super_out = Dropout(dropout, name='dropout')(super_out)
-    self_out = GlobalAveragePooling2D(name='self_gap')(self_out)
     
-    super_out = Dense(nb_classes, name='super_clf', **fc_params)(super_out)
+    # The classifier is shared so inference can skip the dropout layer.
+    super_clf = Dense(nb_classes, name='super_clf', **fc_params)
+    super_out = super_clf(super_out)
     self_out = Dense(6, name='self_clf', **fc_params)(self_out)
 
     sesemi_model = Model(inputs=[self_in, super_in],
                          outputs=[self_out, super_out])
-    inference_model = Model(inputs=[super_in], outputs=[super_out])
+    inference_model = Model(inputs=[super_in],
+                            outputs=[super_clf(super_features)])
     #vat_loss1 = vat_loss(cnn_trunk,input_shape,self_out,self_in)
     #sesemi_model.add_loss(vat_loss1)
 	
@@ -251,9 +383,12 @@ class LRScheduler(Callback):
         self.max_iter = float(max_iter)
         self.power = power
         self.batches = 0
+        # Polynomial decay for every batch, computed once up front.
+        decay = 1.0 - np.arange(int(max_iter)) / self.max_iter
+        self.schedule = (base_lr * decay ** power).tolist()
         
     def on_batch_begin(self, batch, logs={}):
-        lr = self.base_lr * (1.0 - (self.batches / self.max_iter)) ** self.power
+        lr = self.schedule[min(self.batches, len(self.schedule) - 1)]
         K.set_value(self.model.optimizer.lr, lr)
         self.batches += 1
         
@@ -262,32 +397,34 @@ class LRScheduler(Callback):
 
 
 class DenseEvaluator(Callback):
-    def __init__(self, inference_model, validation_data, hflip):
+    def __init__(self, inference_model, validation_data, hflip,
+                 batch_size=512):
         x_val = validation_data[0]
         y_val = validation_data[1]
 
-        self.data = []
         self.labels = y_val
         self.inference_model = inference_model
         self.hflip = hflip
+        self.batch_size = batch_size
         
-        for x in x_val:
-            t = jitter(x)
-            noisy_x = gaussian_noise(x)
-            noisy_t = gaussian_noise(t)
-            if self.hflip:
-                flipx = np.fliplr(x)
-                flipt = np.fliplr(t)
-                noisy_flipx = gaussian_noise(flipx)
-                noisy_flipt = gaussian_noise(flipt)
-                self.data.append([x, t, noisy_x, noisy_t,
-                                  flipx, flipt, noisy_flipx, noisy_flipt])
-            else:
-                self.data.append([x, t, noisy_x, noisy_t])
-        self.data = np.vstack(self.data)
+        # Build every test-time view for the whole set at once, writing
+        # into axis 1 so the views of each image stay consecutive.
+        t_val = jitter_batch(x_val)
+        pairs = [(x_val, t_val)]
+        if self.hflip:
+            pairs.append((x_val[:, :, ::-1, :], t_val[:, :, ::-1, :]))
+        self.data = np.empty((len(x_val), 4 * len(pairs)) + x_val.shape[1:],
+                             dtype='float32')
+        for k, (x, t) in enumerate(pairs):
+            self.data[:, 4 * k] = x
+            self.data[:, 4 * k + 1] = t
+            gaussian_noise(x, out=self.data[:, 4 * k + 2])
+            gaussian_noise(t, out=self.data[:, 4 * k + 3])
+        self.data = self.data.reshape((-1,) + x_val.shape[1:])
         
     def on_epoch_end(self, epoch, logs={}):
-        y_pred = self.inference_model.predict(self.data, batch_size=64)
+        y_pred = self.inference_model.predict(
+            self.data, batch_size=min(self.batch_size, len(self.data)))
         if self.hflip:
             y_pred = y_pred.reshape((len(y_pred) // 8, 8, -1))
         else: